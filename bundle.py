@@ -0,0 +1,175 @@
+import html
+import io
+import json
+import os
+import posixpath
+import re
+import zipfile
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+# Name of the JSON index stored inside every bundle archive
+INDEX_NAME = 'index.json'
+# Where the page itself lives inside the archive
+PAGE_NAME = 'index.html'
+
+# The start tags SubresourceParser takes refs from. Quoted values may contain '>' so skip over them whole
+SUBRESOURCE_TAG = re.compile(rb"""<(?:link|script|img)\b(?:[^>"']|"[^"]*"|'[^']*')*>""", re.IGNORECASE)
+# A src= or href= attribute inside one of those tags (not data-src=, ...), quoted or bare
+LINK_ATTRIBUTE = re.compile(rb"""((?<![\w-])(?:src|href)\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)""", re.IGNORECASE)
+
+
+class SubresourceParser(HTMLParser):
+    """
+    Collects the raw attribute values of the subresources a page needs to render:
+    stylesheets (and icons), scripts and images.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.refs = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        ref = None
+        if tag == 'link':
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'stylesheet' in rel or 'icon' in rel:
+                ref = attrs.get('href')
+        elif tag in ('script', 'img'):
+            ref = attrs.get('src')
+
+        if ref and ref not in self.refs:
+            self.refs.append(ref)
+
+
+def find_subresources(html_text: str, page_url: str) -> dict[str, str]:
+    """
+    Finds the same-origin CSS/JS/images referenced by a page.
+
+    Args:
+        html_text: the fetched page
+        page_url: the URL the page was fetched from, ex. "http://example.com/index.html"
+
+    Returns:
+        {attribute value as HTMLParser read it (entities unescaped): absolute URL to fetch}
+    """
+    parser = SubresourceParser()
+    try:
+        parser.feed(html_text)
+        parser.close()
+    except Exception as e:
+        # Broken HTML still gets sent, just without its subresources
+        print(f"Error parsing HTML for subresources: {e}")
+
+    page_origin = urlsplit(page_url)[:2]
+    subresources = {}
+    for ref in parser.refs:
+        # data: URIs are already inline
+        if ref.startswith('data:'):
+            continue
+        absolute = urljoin(page_url, ref)
+        if urlsplit(absolute)[:2] == page_origin:
+            subresources[ref] = absolute
+    return subresources
+
+
+def build_bundle(page_bytes: bytes, assets: dict[str, bytes]) -> bytes:
+    """
+    Packs a page and its fetched subresources into one compressed zip archive.
+
+    Args:
+        page_bytes: the page itself
+        assets: {raw attribute value from the HTML: fetched bytes}
+
+    Returns:
+        zip archive bytes containing PAGE_NAME, assets/* and INDEX_NAME
+    """
+    index = {'page': PAGE_NAME, 'assets': {}}
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        archive.writestr(PAGE_NAME, page_bytes)
+        for i, (ref, content) in enumerate(assets.items()):
+            # Number the files so two assets called style.css in different folders don't collide
+            basename = posixpath.basename(urlsplit(ref).path) or 'asset'
+            archive_path = f'assets/{i}_{basename}'
+            archive.writestr(archive_path, content)
+            index['assets'][ref] = archive_path
+        archive.writestr(INDEX_NAME, json.dumps(index))
+    return buffer.getvalue()
+
+
+def ref_spellings(ref: str) -> list[bytes]:
+    """
+    The ways a subresource reference may be spelled in the raw page bytes.
+
+    HTMLParser unescapes attribute values, so a ref written as "x.png?a=1&amp;b=2" reaches
+    us as "x.png?a=1&b=2". We don't know the page's encoding here, so try UTF-8 and latin-1.
+
+    Returns:
+        distinct byte strings to look for, ex. [b"x.png?a=1&b=2", b"x.png?a=1&amp;b=2"]
+    """
+    spellings = []
+    for text in (ref, html.escape(ref, quote=False), html.escape(ref)):
+        for encoding in ('utf-8', 'latin-1'):
+            try:
+                written = text.encode(encoding)
+            except UnicodeEncodeError:
+                continue
+            if written not in spellings:
+                spellings.append(written)
+    return spellings
+
+
+def unpack_bundle(bundle_bytes: bytes, out_dir: str) -> str:
+    """
+    Unpacks a bundle from build_bundle into out_dir and rewrites the page's links to the local copies.
+
+    Args:
+        bundle_bytes: the received archive
+        out_dir: directory to write the page and its assets into
+
+    Returns:
+        path of the unpacked page
+    """
+    with zipfile.ZipFile(io.BytesIO(bundle_bytes)) as archive:
+        index = json.loads(archive.read(INDEX_NAME))
+        os.makedirs(out_dir, exist_ok=True)
+
+        # Only extract the paths we put there ourselves (never trust names like ../../x)
+        for archive_path in index['assets'].values():
+            if archive_path.startswith('/') or '..' in archive_path.split('/'):
+                raise ValueError(f"Unsafe path in bundle: {archive_path}")
+            local_path = os.path.join(out_dir, *archive_path.split('/'))
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with open(local_path, 'wb') as f:
+                f.write(archive.read(archive_path))
+
+        # Rewrite the raw bytes so pages that aren't UTF-8 come out unchanged
+        page = archive.read(index['page'])
+
+    # {every way a ref may be written: local file}
+    local_paths = {}
+    for ref, archive_path in index['assets'].items():
+        for written in ref_spellings(ref):
+            local_paths[written] = archive_path.encode('utf-8')
+
+    def rewrite_attribute(match):
+        value = match.group(2)
+        quote = value[:1] if value[:1] in (b'"', b"'") else b''
+        local = local_paths.get(value[len(quote):len(value) - len(quote)])
+        if local is None:
+            return match.group(0)
+        return match.group(1) + quote + local + quote
+
+    def rewrite_tag(match):
+        return LINK_ATTRIBUTE.sub(rewrite_attribute, match.group(0))
+
+    # Only point the src/href of link/script/img tags at the local files, so the same URL in an
+    # <a href> or a script string still goes to the server
+    page = SUBRESOURCE_TAG.sub(rewrite_tag, page)
+
+    page_path = os.path.join(out_dir, PAGE_NAME)
+    with open(page_path, 'wb') as f:
+        f.write(page)
+    return page_path
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import time
+
+# Default location and size of the on-disk cache the client keeps between runs
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dns_tunnel')
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+
+class ClientCache:
+    """
+    Persistent, size-bounded cache of files received through the tunnel.
+
+    Bodies are stored content-addressed under objects/<sha256>, so two names that
+    resolve to the same content share one file on disk. index.json maps each requested
+    filename to its object plus the ETag / Last-Modified the server reported for it.
+    When the total size of the objects goes over max_bytes we evict the least
+    recently used entries first.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self) -> dict:
+        # A missing or broken index just means an empty cache
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        # Write to a temp file and rename so a crash never leaves a half written index
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _object_path(self, sha: str) -> str:
+        return os.path.join(self.objects_dir, sha)
+
+    def lookup(self, filename: str) -> dict | None:
+        """
+        Returns the index entry for filename, or None if we have no usable copy.
+
+        Entry keys: sha256, size, etag, last_modified, last_used
+        """
+        entry = self.index.get(filename)
+        if entry is None:
+            return None
+        # The object may have been removed behind our back
+        if not os.path.exists(self._object_path(entry['sha256'])):
+            del self.index[filename]
+            self._save_index()
+            return None
+        return entry
+
+    def read(self, filename: str) -> bytes | None:
+        """Returns the cached body for filename and marks it as recently used."""
+        entry = self.lookup(filename)
+        if entry is None:
+            return None
+        with open(self._object_path(entry['sha256']), 'rb') as f:
+            body = f.read()
+        entry['last_used'] = time.time()
+        self._save_index()
+        return body
+
+    def put(self, filename: str, body: bytes, etag: str | None = None, last_modified: str | None = None):
+        """Stores body for filename, then evicts old entries until we fit in max_bytes."""
+        # Anything bigger than the whole cache can never fit so don't bother
+        if len(body) > self.max_bytes:
+            return
+        sha = hashlib.sha256(body).hexdigest()
+        object_path = self._object_path(sha)
+        if not os.path.exists(object_path):
+            tmp_path = object_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, object_path)
+
+        old_entry = self.index.get(filename)
+        self.index[filename] = {
+            'sha256': sha,
+            'size': len(body),
+            'etag': etag,
+            'last_modified': last_modified,
+            'last_used': time.time(),
+        }
+        if old_entry is not None and old_entry['sha256'] != sha:
+            self._remove_object_if_unused(old_entry['sha256'])
+        self._evict()
+        self._save_index()
+
+    def update_validators(self, filename: str, etag: str | None, last_modified: str | None):
+        """Refreshes the ETag / Last-Modified of an entry after the server confirmed it is current."""
+        entry = self.index.get(filename)
+        if entry is None:
+            return
+        if etag is not None:
+            entry['etag'] = etag
+        if last_modified is not None:
+            entry['last_modified'] = last_modified
+        entry['last_used'] = time.time()
+        self._save_index()
+
+    def _remove_object_if_unused(self, sha: str):
+        # Objects are shared between names so only delete once nothing points at it
+        for entry in self.index.values():
+            if entry['sha256'] == sha:
+                return
+        try:
+            os.remove(self._object_path(sha))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Count each object once, even if several names share it
+        sizes = {}
+        for entry in self.index.values():
+            sizes[entry['sha256']] = entry['size']
+        total = sum(sizes.values())
+
+        # Oldest last_used first
+        by_age = sorted(self.index.items(), key=lambda item: item[1]['last_used'])
+        for filename, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            del self.index[filename]
+            if all(other['sha256'] != entry['sha256'] for other in self.index.values()):
+                total -= sizes.pop(entry['sha256'])
+                self._remove_object_if_unused(entry['sha256'])
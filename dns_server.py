@@ -4,80 +4,146 @@ Simple DNS Server that responds to queries by decoding the base64 label
 contained before the .com suffix and returning it in a TXT record.
 """
 
+import argparse
+import signal
 import socket
+import sys
 import base64
-import requests
+import json
 import math
+import time
 import protocol
-from scapy.all import DNS, DNSQR, DNSRR
+import profiling
+import dns_wire
+from concurrent.futures import ThreadPoolExecutor, wait
+# NOTE: scapy and requests are slow, heavy imports (scapy alone is 1-2 seconds and hundreds of MB),
+# so we only import them inside the functions that use them. bundle (zipfile + html.parser) is only
+# needed for BUNDLE requests so it is imported the same way. DNS packets are built and parsed with
+# dns_wire by default; scapy is only used when the server is started with --scapy
 
 # Configuration
 DNS_PORT = 53  # Standard DNS port (requires root privileges)
 LISTEN_IP = "0.0.0.0"  # Listen on all interfaces
 CHUNK_SIZE = 150  # Reduced to fit in DNS TXT record (255 byte limit) after base64 encoding
+BUNDLE_WORKERS = 8  # Subresources fetched upstream in parallel for BUNDLE requests
+BUNDLE_MAX_ASSETS = 64  # Don't let one huge page turn into hundreds of upstream fetches
+BUNDLE_DEADLINE = 15  # Seconds of upstream fetching (page + assets) per BUNDLE request. Keep below tunnel_client.BUNDLE_TIMEOUT
+BUNDLE_PAGE_TIMEOUT = 5  # requests timeout for the page itself, the rest of the deadline goes to its assets
+USE_SCAPY = False  # Set by --scapy: parse/build packets with scapy instead of dns_wire (debugging fallback)
 
 sessions = {}
 id2seq = {}
 id2data = {}
+# session_id -> {"etag", "last_modified"} upstream sent with the page, handed to the client
+# when it sends a META query after DONE so it can send them back in later COND requests
+id2validators = {}
+# Per-stage timings, only recorded with --profile
+profiler = profiling.Profiler()
 def parse_dns_query(data):
-    """Parse DNS query using scapy."""
+    """Parse DNS query with dns_wire (or scapy with --scapy)."""
     try:
-        dns_packet = DNS(data)
-        return dns_packet
+        if USE_SCAPY:
+            from scapy.all import DNS, DNSQR
+            dns_packet = DNS(data)
+            question = dns_packet[DNSQR]
+            return dns_wire.DNSQuery(dns_packet.id, bool(dns_packet.rd), question.qname,
+                                     question.qtype, question.qclass, bytes(question))
+        return dns_wire.parse_query(data)
     except Exception as e:
         print(f"Error parsing DNS packet: {e}")
         return None
 
+def build_scapy_response(query_packet, answer: str) -> bytes:
+    """Build the TXT response with scapy. Only used with --scapy."""
+    from scapy.all import DNS, DNSQR, DNSRR
+    response = DNS(
+        id=query_packet.id,
+        qr=1,  # This is a response
+        aa=1,  # Authoritative answer
+        rd=query_packet.rd,
+        qd=DNSQR(qname=query_packet.qname, qtype=query_packet.qtype, qclass=query_packet.qclass),  # Copy the query
+        an=DNSRR(
+            rrname=query_packet.qname,
+            type='TXT',  # Return decoded payload as TXT record
+            ttl=300,
+            rdata=answer.encode()
+        )
+    )
+    return bytes(response)
+
 #NOTE: Claude created this SCAPY skeleton
 def create_dns_response(query_packet, src_addr):
-    """Create a DNS response packet using scapy."""
+    """Create a DNS response packet for a parsed query."""
     try:
         # Extract the query details
-        qname = query_packet[DNSQR].qname
-        qtype = query_packet[DNSQR].qtype
-        qclass = query_packet[DNSQR].qclass
+        qname = query_packet.qname
+        qtype = query_packet.qtype
+        qclass = query_packet.qclass
 
         print(f"Query for: {qname.decode() if isinstance(qname, bytes) else qname}")
         print(f"Query type: {qtype}")
 
         print(f"Decoded payload: {qname}")
 
-        answer, seq_to_send = handle_query(qname, src_addr)
+        with profiler.stage("handle_query"):
+            answer, seq_to_send = handle_query(qname, src_addr)
 
-        checksum = protocol.calculate_checksum(answer) #answer in bytes rn
+        with profiler.stage("checksum"):
+            checksum = protocol.calculate_checksum(answer) #answer in bytes rn
 
-        answer = protocol.encode_chunk(answer, seq_to_send, checksum)
+        with profiler.stage("encode_chunk"):
+            answer = protocol.encode_chunk(answer, seq_to_send, checksum)
 
         print(answer)
 
         # Create the response
-        response = DNS(
-            id=query_packet.id,
-            qr=1,  # This is a response
-            aa=1,  # Authoritative answer
-            rd=query_packet.rd,
-            qd=query_packet.qd,  # Copy the query
-            an=DNSRR(
-                rrname=qname,
-                type='TXT',  # Return decoded payload as TXT record
-                ttl=300,
-                rdata=answer.encode()
-            )
-        )
+        with profiler.stage("serialize"):
+            if USE_SCAPY:
+                response_bytes = build_scapy_response(query_packet, answer)
+            else:
+                response_bytes = dns_wire.build_txt_response(query_packet, answer.encode(), ttl=300)
 
-        return bytes(response)
+        return response_bytes
     except Exception as e:
         print(f"Error creating DNS response: {e}")
         return None
 
-def handle_get(query: str) -> str:
+def chunk_content(content_bytes: bytes) -> list[bytes]:
+    """
+    Splits a fetched page into CHUNK_SIZE pieces that each fit in one TXT record.
+
+    Returns:
+        [DATA]
+    """
+    data = []
+    num_chunks = math.ceil(len(content_bytes)/CHUNK_SIZE)
+    #NOTE: Claude pointed out bytes is a system name
+    for i in range(num_chunks):
+        if i != num_chunks - 1:
+            data.append(content_bytes[i*CHUNK_SIZE:(i+1)*CHUNK_SIZE])
+        else: #last chunk may or may not be evenly CHUNK_SIZE
+            data.append(content_bytes[i*CHUNK_SIZE:])
+
+    return data
+
+def response_validators(response) -> dict:
+    """
+    Pulls the HTTP validators we pass on to the client out of an upstream response.
+    """
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+def handle_get(query: str) -> tuple[list[bytes] | None, dict | None]:
     """
     Handles initial GET request. Uses requests library to make appropriate request.
     Chunks data and returns list of chunks.
 
     Returns:
-        [DATA]
+        ([DATA], validators)
     """
+    import requests
     print("making request to ", query)
 
     response = requests.get("http://" + query) #TODO: Only http for now
@@ -88,21 +154,144 @@ def handle_get(query: str) -> str:
         print("HTTP GET", response.text)
         content_bytes = response.content
 
-        data = []
-        num_chunks = math.ceil(len(content_bytes)/CHUNK_SIZE)
-        #NOTE: Claude pointed out bytes is a system name
-        for i in range(num_chunks):
-            if i != num_chunks - 1:
-                data.append(content_bytes[i*CHUNK_SIZE:(i+1)*CHUNK_SIZE])
-            else: #last chunk may or may not be evenly CHUNK_SIZE
-                data.append(content_bytes[i*CHUNK_SIZE:])
-
-        return data
+        return chunk_content(content_bytes), response_validators(response)
 
     else:
         print("BAD REQUEST?") #TODO: gotta handle this
 
     print("FETCHED PAGE", response)
+    return None, None
+
+def handle_cond_get(query: str, client_digest: str, etag: str | None,
+                    last_modified: str | None) -> tuple[list[bytes] | None, dict | None]:
+    """
+    Handles a COND request: only fetch and chunk the page if the client's copy is stale.
+
+    Args:
+        query: page to fetch, ex. "example.com/index.html"
+        client_digest: protocol.content_digest of the client's cached copy
+        etag: ETag of the client's cached copy, or None
+        last_modified: Last-Modified of the client's cached copy, or None
+
+    Returns:
+        (None, validators) if the client's copy is still current
+        ([DATA], validators) if it is stale
+        (None, None) if upstream answered with anything else, the client's copy is NOT confirmed
+    """
+    import requests
+    print("making conditional request to ", query, "client has", client_digest)
+
+    # If the client has validators for its copy, let upstream tell us it hasn't
+    # changed instead of downloading the page again
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    response = requests.get("http://" + query, headers=headers) #TODO: Only http for now
+
+    print("resp", response)
+    if response.status_code == 304 and headers:
+        # A 304 may leave out validators that didn't change, so keep the client's
+        validators = response_validators(response)
+        if validators["etag"] is None:
+            validators["etag"] = etag
+        if validators["last_modified"] is None:
+            validators["last_modified"] = last_modified
+        return None, validators
+
+    if response.status_code == 200:
+        content_bytes = response.content
+        validators = response_validators(response)
+        # Upstream may not support validators, so compare the content itself too
+        if protocol.content_digest(content_bytes) == client_digest:
+            return None, validators
+        return chunk_content(content_bytes), validators
+
+    print("BAD REQUEST?") #TODO: gotta handle this
+    return None, None
+
+def encode_validators(validators: dict | None) -> bytes:
+    """
+    Payload of a NOTMOD or META reply: the validators as JSON so the client can store them in its cache.
+    Drops the validators if they would not fit in a single TXT record.
+    """
+    if validators is None:
+        validators = {"etag": None, "last_modified": None}
+    payload = json.dumps({"etag": validators["etag"], "last_modified": validators["last_modified"]}).encode()
+    if len(payload) > CHUNK_SIZE:
+        payload = json.dumps({"etag": None, "last_modified": None}).encode()
+    return payload
+
+def fetch_subresource(url: str, timeout: float) -> bytes | None:
+    """
+    Fetches one subresource of a bundled page. Returns None if it can't be fetched so the
+    page is still sent without it.
+    """
+    import requests
+    try:
+        response = requests.get(url, timeout=timeout)
+    except Exception as e:
+        print(f"Error fetching subresource {url}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Skipping subresource {url}: HTTP {response.status_code}")
+        return None
+    return response.content
+
+def handle_bundle(query: str) -> list[bytes] | None:
+    """
+    Handles BUNDLE request. Fetches the page, then its same-origin CSS/JS/images in parallel,
+    and chunks one zip archive of all of them so the client gets the whole page in one session.
+    All upstream fetching shares one BUNDLE_DEADLINE, since the client is waiting on chunk 0
+    and the server loop is blocked until we return. Assets not fetched by then are left out.
+
+    Returns:
+        [DATA]
+    """
+    import requests
+    import bundle
+    print("making bundle request to ", query)
+
+    deadline = time.monotonic() + BUNDLE_DEADLINE
+
+    page_url = "http://" + query #TODO: Only http for now
+    try:
+        response = requests.get(page_url, timeout=BUNDLE_PAGE_TIMEOUT)
+    except Exception as e:
+        print(f"Error fetching {page_url}: {e}")
+        return None
+
+    print("resp", response)
+    if response.status_code != 200:
+        print("BAD REQUEST?") #TODO: gotta handle this
+        return None
+
+    page_bytes = response.content
+    subresources = bundle.find_subresources(response.text, page_url)
+    refs = list(subresources)[:BUNDLE_MAX_ASSETS]
+    print(f"bundling {len(refs)} subresources")
+
+    assets = {}
+    remaining = deadline - time.monotonic()
+    if refs and remaining > 0:
+        pool = ThreadPoolExecutor(max_workers=BUNDLE_WORKERS)
+        futures = {pool.submit(fetch_subresource, subresources[ref], remaining): ref for ref in refs}
+        done, not_done = wait(futures, timeout=remaining)
+        # Don't wait for stragglers: their requests timeouts end them shortly after the deadline anyway
+        pool.shutdown(wait=False, cancel_futures=True)
+        if not_done:
+            print(f"bundle deadline hit, leaving out {len(not_done)} subresources")
+        # Keep the page's order so the archive is the same for the same page
+        for future, ref in futures.items():
+            if future in done and future.result() is not None:
+                assets[ref] = future.result()
+
+    archive = bundle.build_bundle(page_bytes, assets)
+    print(f"bundle is {len(archive)} bytes ({len(assets)} assets)")
+
+    return chunk_content(archive)
 
 def handle_query(query_bytes: str, src_dst: str) -> str:
     """
@@ -123,12 +312,54 @@ def handle_query(query_bytes: str, src_dst: str) -> str:
 
        id2seq[session_id] = 0
 
-       id2data[session_id] = handle_get(query.replace("-", "."))
+       id2data[session_id], id2validators[session_id] = handle_get(query.replace("-", "."))
 
        print(id2data)
 
        return id2data[session_id][0], 0
 
+    elif query_string.startswith("BUNDLE"):
+        query, session_id, tunnel, local, _ = query_string[7:].split(".")#BUNDLE- is 7 char
+
+        sessions[src_dst] = session_id
+
+        id2seq[session_id] = 0
+
+        id2validators[session_id] = None
+
+        data = handle_bundle(query.replace("-", "."))
+
+        if data is None:
+            # Page fetch failed (404, timeout, ...) so answer right away instead of leaving the client waiting
+            return b"upstream_error", "ERROR"
+
+        id2data[session_id] = data
+
+        return id2data[session_id][0], 0
+
+    elif query_string.startswith("COND"):
+        # COND-<file>.<digest>[.<validators>].<session>.tunnel.local. -> answer NOTMOD in one packet if the client is current
+        query, client_digest, session_id, etag, last_modified = protocol.decode_request(query_string.rstrip("."), "COND")
+
+        data, validators = handle_cond_get(query, client_digest, etag, last_modified)
+
+        if data is None:
+            if validators is None:
+                # Upstream failed (404, 500, ...) so we can't vouch for the client's copy
+                return b"upstream_error", "ERROR"
+            return encode_validators(validators), "NOTMOD"
+
+        # Client copy is stale so start a normal Stop-and-Wait session with the new content
+        sessions[src_dst] = session_id
+
+        id2seq[session_id] = 0
+
+        id2validators[session_id] = validators
+
+        id2data[session_id] = data
+
+        return id2data[session_id][0], 0
+
     elif query_string.startswith("ACK"):
 
         seq = int(query_string[4])
@@ -147,6 +378,13 @@ def handle_query(query_bytes: str, src_dst: str) -> str:
 
         return id2data[session_id][id2seq[session_id]], id2seq[session_id] % 2
 
+    elif query_string.startswith("META"):
+        # META.<session>.tunnel.local. -> the validators of the file this session sent, for the client's cache.
+        # Its own query (not an ACK reply) so it can never be mistaken for a data chunk
+        _, session_id, tunnel, local, _ = query_string.split(".")
+
+        return encode_validators(id2validators.get(session_id)), "META"
+
     else:
         print("Unknown flag", query_string[:3])
 
@@ -172,36 +410,59 @@ def start_dns_server():
         print(f"Error binding to port: {e}")
         return
 
-    # Main server loop
-    while True:
-        try:
-            # Receive DNS query
-            data, addr = sock.recvfrom(512)  # DNS packets are typically 512 bytes max
-            print(f"\n{'='*50}")
-            print(f"Received query from {addr[0]}:{addr[1]}")
-
-            # Parse the query
-            query = parse_dns_query(data)
-            if query is None:
-                continue
-            # Create response
-            response = create_dns_response(query, addr[0])
+    # Main server loop. The finally makes sure an unexpected exception or SIGTERM
+    # (see __main__) still closes the socket and writes out the profile
+    try:
+        while True:
+            try:
+                # Receive DNS query
+                data, addr = sock.recvfrom(512)  # DNS packets are typically 512 bytes max
+                print(f"\n{'='*50}")
+                print(f"Received query from {addr[0]}:{addr[1]}")
+
+                # Parse the query
+                with profiler.stage("parse"):
+                    query = parse_dns_query(data)
+                if query is None:
+                    continue
+                # Create response
+                response = create_dns_response(query, addr[0])
             
-            if response is None:
+                if response is None:
+                    continue
+                # Send response
+                with profiler.stage("send"):
+                    sock.sendto(response, addr)
+                print("Sent response with TXT payload")
+
+            except KeyboardInterrupt:
+                print("\n\nShutting down DNS server...")
+                break
+            except Exception as e:
+                print(f"Error handling request: {e}")
                 continue
-            # Send response
-            sock.sendto(response, addr)
-            print("Sent response with TXT payload")
+    finally:
+        sock.close()
+        print("DNS Server stopped.")
 
-        except KeyboardInterrupt:
-            print("\n\nShutting down DNS server...")
-            break
-        except Exception as e:
-            print(f"Error handling request: {e}")
-            continue
-
-    sock.close()
-    print("DNS Server stopped.")
+        profiler.report()
+        profiler.dump()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DNS Tunnel Server')
+    parser.add_argument('--scapy', action='store_true',
+                        help='Parse and build DNS packets with scapy instead of the built-in parser (slower, for debugging)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record per-stage timings and print a histogram on shutdown')
+    parser.add_argument('--profile-out',
+                        help='With --profile, also write a cProfile file (.pstats/.prof) or a Chrome trace JSON (anything else)')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler.enable(args.profile_out)
+    USE_SCAPY = args.scapy
+
+    # Turn SIGTERM (kill, systemd, timeout) into a normal exit so start_dns_server's finally runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     start_dns_server()
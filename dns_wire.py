@@ -0,0 +1,168 @@
+import struct
+from collections import namedtuple
+
+# Only the bits of the DNS wire format (RFC 1035) the tunnel needs: one TXT question out,
+# one TXT answer back. Pure standard library so the client and server don't have to pay
+# for importing scapy just to build and parse these packets.
+
+TYPE_TXT = 16
+CLASS_IN = 1
+
+# Header flag bits
+FLAG_QR = 0x8000  # this is a response
+FLAG_AA = 0x0400  # authoritative answer
+FLAG_RD = 0x0100  # recursion desired
+
+# Largest single character-string in a TXT record
+TXT_STRING_MAX = 255
+
+# A parsed query. qname is bytes with the trailing dot (b"GET-index-html.abc123.tunnel.local."),
+# the same as scapy's DNSQR.qname, and question is the raw question section so a response can echo it
+DNSQuery = namedtuple('DNSQuery', ['id', 'rd', 'qname', 'qtype', 'qclass', 'question'])
+
+
+def take(packet: bytes, offset: int, length: int) -> bytes:
+    """
+    Returns packet[offset:offset+length], raising ValueError instead of silently
+    coming up short when the packet is truncated.
+    """
+    if offset < 0 or offset + length > len(packet):
+        raise ValueError(f"Truncated DNS packet: need {length} bytes at offset {offset}, have {len(packet)}")
+    return packet[offset:offset + length]
+
+
+def encode_name(name: str) -> bytes:
+    """
+    Encodes a domain name as DNS labels.
+
+    Args:
+        name: ex. "GET-index-html.abc123.tunnel.local"
+
+    Returns:
+        b"\\x0eGET-index-html\\x06abc123\\x06tunnel\\x05local\\x00"
+    """
+    encoded = b''
+    for label in name.rstrip('.').split('.'):
+        label_bytes = label.encode('ascii')
+        if not 0 < len(label_bytes) <= 63:
+            raise ValueError(f"Invalid DNS label length {len(label_bytes)}: {label}")
+        encoded += bytes([len(label_bytes)]) + label_bytes
+    return encoded + b'\x00'
+
+
+def read_name(packet: bytes, offset: int) -> tuple[bytes, int]:
+    """
+    Reads a (possibly compressed) domain name starting at offset.
+
+    Returns:
+        (name with trailing dot, offset just past the name in the original position)
+
+    Raises:
+        ValueError if the name runs off the end of the packet or loops
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = take(packet, offset, 1)[0]
+        if length & 0xC0 == 0xC0:
+            # Compression pointer: the rest of the name lives somewhere earlier in the packet
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 16:
+                raise ValueError("Too many compression pointers in DNS name")
+            offset = struct.unpack('!H', take(packet, offset, 2))[0] & 0x3FFF
+            continue
+        if length & 0xC0:
+            raise ValueError(f"Unsupported DNS label type {length:#x}")
+        offset += 1
+        if length == 0:
+            break
+        labels.append(take(packet, offset, length))
+        offset += length
+    if end is None:
+        end = offset
+    return b'.'.join(labels) + b'.', end
+
+
+def build_query(qname: str, query_id: int, qtype: int = TYPE_TXT) -> bytes:
+    """
+    Builds a recursive DNS query packet with a single question.
+    """
+    header = struct.pack('!HHHHHH', query_id, FLAG_RD, 1, 0, 0, 0)
+    return header + encode_name(qname) + struct.pack('!HH', qtype, CLASS_IN)
+
+
+def parse_query(packet: bytes) -> DNSQuery:
+    """
+    Parses the header and first question of a DNS query packet.
+    """
+    if len(packet) < 12:
+        raise ValueError("DNS packet shorter than its header")
+    query_id, flags, qdcount = struct.unpack('!HHH', packet[:6])
+    if qdcount < 1:
+        raise ValueError("DNS query has no question")
+    qname, offset = read_name(packet, 12)
+    qtype, qclass = struct.unpack('!HH', take(packet, offset, 4))
+    question = packet[12:offset + 4]
+    return DNSQuery(query_id, bool(flags & FLAG_RD), qname, qtype, qclass, question)
+
+
+def build_txt_response(query: DNSQuery, txt: bytes, ttl: int = 300) -> bytes:
+    """
+    Builds an authoritative response answering query with one TXT record.
+    """
+    flags = FLAG_QR | FLAG_AA | (FLAG_RD if query.rd else 0)
+    header = struct.pack('!HHHHHH', query.id, flags, 1, 1, 0, 0)
+
+    # TXT rdata is a list of <length><bytes> strings of at most 255 bytes each
+    rdata = b''
+    for i in range(0, max(len(txt), 1), TXT_STRING_MAX):
+        piece = txt[i:i + TXT_STRING_MAX]
+        rdata += bytes([len(piece)]) + piece
+
+    # 0xC00C points the answer name back at the question name right after the header
+    answer = struct.pack('!HHHIH', 0xC00C, TYPE_TXT, CLASS_IN, ttl, len(rdata)) + rdata
+    return header + query.question + answer
+
+
+def parse_txt_response(packet: bytes) -> tuple[int, int, list[bytes]]:
+    """
+    Parses a DNS response and pulls out its TXT answers.
+
+    Returns:
+        (response id, rcode, [rdata of each TXT answer with its strings joined])
+
+    Raises:
+        ValueError if the packet is truncated or malformed
+    """
+    if len(packet) < 12:
+        raise ValueError("DNS packet shorter than its header")
+    response_id, flags, qdcount, ancount = struct.unpack('!HHHH', packet[:8])
+    rcode = flags & 0x000F
+
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = read_name(packet, offset)
+        take(packet, offset, 4)  # qtype, qclass
+        offset += 4
+
+    txt_records = []
+    for _ in range(ancount):
+        _, offset = read_name(packet, offset)
+        rtype, _, _, rdlength = struct.unpack('!HHIH', take(packet, offset, 10))
+        offset += 10
+        rdata = take(packet, offset, rdlength)
+        offset += rdlength
+        if rtype != TYPE_TXT:
+            continue
+        strings = []
+        i = 0
+        while i < len(rdata):
+            length = rdata[i]
+            strings.append(take(rdata, i + 1, length))
+            i += 1 + length
+        txt_records.append(b''.join(strings))
+
+    return response_id, rcode, txt_records
@@ -0,0 +1,128 @@
+import json
+import os
+import time
+
+# Widest histogram bar printed by Profiler.report
+BAR_WIDTH = 40
+
+
+class _NullStage:
+    """What Profiler.stage hands out while profiling is off: entering and leaving it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """Times one run of a named stage and reports it back to its Profiler."""
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, self.start_ns, time.perf_counter_ns())
+        return False
+
+
+class Profiler:
+    """
+    Opt-in per-stage timing for the client and server.
+
+    Code wraps each stage of handling a packet in `with profiler.stage("name"):`.
+    While the profiler is disabled that returns the shared NULL_STAGE, so the only cost is
+    one method call per stage. Once enabled we keep every duration so report() can print
+    a histogram per stage, and dump() can write either a cProfile/pstats file
+    (out_path ending in .pstats or .prof) or a Chrome trace JSON file (anything else,
+    open it in chrome://tracing or Perfetto).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.out_path = None
+        self.durations = {}  # {stage name: [duration_ns, ...]} in the order we first saw each stage
+        self.events = []  # (name, start_ns, end_ns) for the Chrome trace
+        self.cprofile = None
+        self.origin_ns = 0
+
+    def enable(self, out_path: str | None = None):
+        """Starts recording. If out_path is a .pstats/.prof file we also run cProfile."""
+        self.enabled = True
+        self.out_path = out_path
+        self.origin_ns = time.perf_counter_ns()
+        if out_path is not None and out_path.endswith(('.pstats', '.prof')):
+            # NOTE: only imported when asked for so profiling costs nothing when off
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stage(self, name: str):
+        """Context manager timing one run of stage name."""
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name: str, start_ns: int, end_ns: int):
+        self.durations.setdefault(name, []).append(end_ns - start_ns)
+        if self.out_path is not None and self.cprofile is None:
+            self.events.append((name, start_ns, end_ns))
+
+    def report(self):
+        """Prints count/total/mean/p50/p95/max per stage and a log2 histogram of the durations."""
+        if not self.enabled:
+            return
+        print(f"\n=== PROFILE (per-stage latency) ===")
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            count = len(ordered)
+            total_ms = sum(ordered) / 1e6
+            p50 = ordered[count // 2] / 1e3
+            p95 = ordered[min(count - 1, int(count * 0.95))] / 1e3
+            print(f"\n{name}: n={count} total={total_ms:.2f}ms mean={total_ms * 1e3 / count:.1f}us "
+                  f"p50={p50:.1f}us p95={p95:.1f}us max={ordered[-1] / 1e3:.1f}us")
+
+            # Bucket i holds durations in [2^i, 2^(i+1)) microseconds, bucket 0 is everything under 2us
+            buckets = {}
+            for duration in ordered:
+                bucket = max(0, int(duration // 1000).bit_length() - 1)
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+            largest = max(buckets.values())
+            for bucket in range(min(buckets), max(buckets) + 1):
+                bucket_count = buckets.get(bucket, 0)
+                low = 0 if bucket == 0 else 2 ** bucket
+                bar = '#' * max(1 if bucket_count else 0, bucket_count * BAR_WIDTH // largest)
+                print(f"  {low:>9}us+ | {bar} {bucket_count}")
+
+    def dump(self):
+        """Writes the pstats or Chrome trace file if enable() was given an out_path."""
+        if not self.enabled or self.out_path is None:
+            return
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.out_path)
+        else:
+            # Chrome trace "complete" events, timestamps in microseconds
+            trace_events = []
+            for name, start_ns, end_ns in self.events:
+                trace_events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start_ns - self.origin_ns) / 1e3,
+                    'dur': (end_ns - start_ns) / 1e3,
+                    'pid': os.getpid(),
+                    'tid': 0,
+                })
+            with open(self.out_path, 'w') as f:
+                json.dump({'traceEvents': trace_events}, f)
+        print(f"Profile written to {self.out_path}")
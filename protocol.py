@@ -1,6 +1,16 @@
 import base64
+import hashlib
 import struct
 
+# Number of hex characters of the sha256 digest we put in COND queries. Must fit in one DNS label
+DIGEST_LEN = 16
+# DNS limits: 63 bytes per label, 253 for the whole name
+MAX_LABEL_LEN = 63
+MAX_NAME_LEN = 253
+# First character of the COND labels carrying the cached copy's HTTP validators
+ETAG_PREFIX = 'e'
+LAST_MODIFIED_PREFIX = 'm'
+
 def encode_get(filename: str, session_id: str) -> str:
     """
     Encodes file request as DNS query string. Inverse of decode_request with expected = GET
@@ -14,6 +24,21 @@ def encode_get(filename: str, session_id: str) -> str:
 
     return "GET-" +  filename.replace('.','-') + '.'+ session_id + '.tunnel.local'
 
+def encode_bundle(filename: str, session_id: str) -> str:
+    """
+    Encodes page bundle request as DNS query string. Inverse of decode_request with expected = BUNDLE
+    The server answers with one zip archive of the page plus its same-origin CSS/JS/images.
+
+    Args:
+        filename: ex, "index.html"
+        session_id: 6 character alphanumeric string
+
+    Returns:
+        Formatted DNS query: ex. "BUNDLE-index-html.abc123.tunnel.local"
+    """
+
+    return "BUNDLE-" + filename.replace('.','-') + '.' + session_id + '.tunnel.local'
+
 def encode_ack(seq: int, session_id: str) -> str:
     """
     Encode ACK as DNS query string. Inverse of decode_request with expected = ACK
@@ -27,17 +52,87 @@ def encode_ack(seq: int, session_id: str) -> str:
 
     return 'ACK-'+ str(seq) + '.' + session_id + '.tunnel.local'
 
+def encode_validator_labels(prefix: str, value: str) -> list[str]:
+    """
+    Encodes an HTTP validator (ETag or Last-Modified) as DNS labels. Inverse of decode_validator_labels
+    Validators can hold any printable character and DNS may change the case of a name, so we
+    use lowercase base32 without padding, split into labels that each start with prefix.
+
+    Returns:
+        ex. ["mk5sgkljmeqdemjaj5rwiidcgaytkidqg44dkorsha5dambaj5duk"]
+    """
+    encoded = base64.b32encode(value.encode()).decode('ascii').rstrip('=').lower()
+    piece_len = MAX_LABEL_LEN - len(prefix)
+    return [prefix + encoded[i:i+piece_len] for i in range(0, len(encoded), piece_len)]
+
+def decode_validator_labels(labels: list[str]) -> str:
+    """
+    Joins labels from encode_validator_labels (prefix already stripped) back into the validator.
+    """
+    encoded = ''.join(labels).upper()
+    # Put back the padding we stripped
+    encoded += '=' * (-len(encoded) % 8)
+    return base64.b32decode(encoded).decode()
+
+def encode_meta(session_id: str) -> str:
+    """
+    Encodes the request for a finished session's ETag / Last-Modified as DNS query string.
+    The client only sends it after it has a verified DONE chunk.
+
+    Args:
+        session_id: 6 character alphanumeric string
+
+    Returns:
+        Formatted DNS query: ex. "META.abc123.tunnel.local"
+    """
+
+    return 'META.' + session_id + '.tunnel.local'
+
+def encode_cond_get(filename: str, digest: str, session_id: str, etag: str | None = None,
+                    last_modified: str | None = None) -> str:
+    """
+    Encodes a conditional file request as DNS query string. Inverse of decode_request with expected = COND
+    The server only sends the file back if its content no longer matches digest. The ETag and
+    Last-Modified of the cached copy ride along so the server can ask upstream with
+    If-None-Match / If-Modified-Since. A validator that would make the name too long is left out.
+
+    Args:
+        filename: ex, "index.html"
+        digest: short hex digest of the client's cached copy (see content_digest)
+        session_id: 6 character alphanumeric string
+        etag: ETag upstream sent with the cached copy, or None
+        last_modified: Last-Modified upstream sent with the cached copy, or None
+
+    Returns:
+        Formatted DNS query: ex. "COND-index-html.9f86d081884c7d65.abc123.tunnel.local"
+        or with validators "COND-index-html.9f86d081884c7d65.e<base32>.m<base32>.abc123.tunnel.local"
+    """
+    head = "COND-" + filename.replace('.','-') + '.' + digest
+    tail = '.' + session_id + '.tunnel.local'
+
+    validator_labels = []
+    for prefix, value in ((ETAG_PREFIX, etag), (LAST_MODIFIED_PREFIX, last_modified)):
+        if not value:
+            continue
+        labels = encode_validator_labels(prefix, value)
+        length = len(head) + len(tail) + sum(len(label) + 1 for label in validator_labels + labels)
+        if length <= MAX_NAME_LEN:
+            validator_labels += labels
+
+    return head + ''.join('.' + label for label in validator_labels) + tail
+
 def decode_request(query: str, expected: str) -> tuple[str|int, str]:
     """
     Parses DNS request query (GET or ACK). Inverse of encode_ack or encode_get
 
     Args:
         query: DNS query string (from above functions)
-        expected: "GET" or "ACK"
+        expected: "GET", "BUNDLE", "ACK" or "COND"
 
     Returns:
-        if expected="GET" => (filename, session_id)
+        if expected="GET" or "BUNDLE" => (filename, session_id)
         if expected="ACK" => (seq_num, session_id)
+        if expected="COND" => (filename, digest, session_id, etag_or_None, last_modified_or_None)
     """
     # NOTE: ChatGPT suggested I add this check of the suffix before doing any query processing
     if not query.endswith('.tunnel.local'):
@@ -46,6 +141,33 @@ def decode_request(query: str, expected: str) -> tuple[str|int, str]:
 
     chunks = query.split('.')
 
+    if expected == "COND":
+        # COND queries carry the digest of the cached copy, then optional validator labels
+        if len(chunks) < 3:
+            raise ValueError(f"Invalid query format: expected at least 3 parts, got {len(chunks)}")
+        command, digest, validator_labels, session_id = chunks[0], chunks[1], chunks[2:-1], chunks[-1]
+        command_chunks = command.split('-')
+        if command_chunks[0] != 'COND':
+            raise ValueError(f"Expected COND request, got: {command}")
+        filename = '.'.join(command_chunks[1:])
+
+        etag_labels = []
+        last_modified_labels = []
+        for label in validator_labels:
+            # DNS may have changed the case of the prefix too
+            if label[:1].lower() == ETAG_PREFIX:
+                etag_labels.append(label[1:])
+            elif label[:1].lower() == LAST_MODIFIED_PREFIX:
+                last_modified_labels.append(label[1:])
+            else:
+                raise ValueError(f"Unknown COND validator label: {label}")
+        try:
+            etag = decode_validator_labels(etag_labels) if etag_labels else None
+            last_modified = decode_validator_labels(last_modified_labels) if last_modified_labels else None
+        except (ValueError, UnicodeDecodeError) as e:
+            raise ValueError(f"Invalid COND validator labels: {e}")
+        return (filename, digest, session_id, etag, last_modified)
+
     if len(chunks) != 2:
         raise ValueError(f"Invalid query format: expected 2 parts, got {len(chunks)}")
 
@@ -53,14 +175,14 @@ def decode_request(query: str, expected: str) -> tuple[str|int, str]:
 
     command_chunks = command.split('-')
 
-    if expected == "GET":
+    if expected in ("GET", "BUNDLE"):
         # Parse "GET-index-html" -> "index.html"
-        if command_chunks[0] != 'GET':
-            raise ValueError(f"Expected GET request, got: {command}")
+        if command_chunks[0] != expected:
+            raise ValueError(f"Expected {expected} request, got: {command}")
 
         # Join all parts after GET and replace '-' with '.'
         # GET-index-html -> ["GET", "index", "html"] -> "index.html"
-        filename_parts = command_chunks[1:]  # Skip "GET"
+        filename_parts = command_chunks[1:]  # Skip "GET" / "BUNDLE"
         filename = '.'.join(filename_parts)
         return (filename, session_id)
 
@@ -80,7 +202,9 @@ def encode_chunk(data_binary: bytes, seq: int|str, checksum: str) -> str:
 
     Args:
         data: bytes
-        seq: 0, 1, or "DONE" (alternating bit for Stop-and-Wait protocol as we defined)
+        seq: 0, 1, "DONE", "NOTMOD", "META" or "ERROR" (alternating bit for Stop-and-Wait protocol as we defined,
+             NOTMOD answers a COND request whose cached copy is still current, META answers a META
+             request with the file's ETag / Last-Modified, ERROR carries an error message)
         checksum: 4 characters long (16-bit Internet Checksum)
 
     Returns:
@@ -113,9 +237,9 @@ def decode_chunk(txt_record: str) -> tuple[int|str, bytes, str]:
 
     seq, data_base64, checksum = chunks
 
-    # Parse sequence number (could be int or "DONE")
-    if seq == "DONE":
-        seq = "DONE"
+    # Parse sequence number (could be int, "DONE", "NOTMOD", "META" or "ERROR")
+    if seq in ("DONE", "NOTMOD", "META", "ERROR"):
+        pass
     else:
         seq = int(seq)
 
@@ -160,3 +284,15 @@ def calculate_checksum(bytes_to_checksum: bytes) -> str:
     # Return as 4 character string in hexidecimal 
     return f"{checksum:04x}"
 
+
+def content_digest(content: bytes) -> str:
+    """
+    Short content digest used to tell whether a cached copy is still current.
+
+    Args:
+        content: full file bytes
+
+    Returns:
+        the first DIGEST_LEN hex characters of the sha256 of content
+    """
+    return hashlib.sha256(content).hexdigest()[:DIGEST_LEN]
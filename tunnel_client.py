@@ -3,8 +3,21 @@ import random
 import string
 import time
 import os
+import json
+import socket
 import protocol
-from scapy.all import IP, DNSQR, UDP, DNS, sr1
+import profiling
+import dns_wire
+from client_cache import ClientCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+# NOTE: everything above is standard library or ours, so the client starts fast and runs on small
+# devices. scapy is only imported for --scapy and bundle (zipfile, html.parser) only for --bundle
+
+# Set by --scapy: send queries with scapy's sr1 instead of a plain UDP socket (debugging fallback)
+USE_SCAPY = False
+
+# How long to wait for chunk 0 of a BUNDLE request. The server fetches the page and all its
+# assets before answering, so this must stay above dns_server.BUNDLE_DEADLINE (15 s)
+BUNDLE_TIMEOUT = 30.0
 
 
 # MACROS for testing. I wanted to directly simulate what happens if you drop or corrupt 
@@ -18,6 +31,9 @@ TEST_MODE = os.getenv('TEST_MODE', 'false').lower() == 'true'
 TEST_DROP_RATE = float(os.getenv('TEST_DROP_RATE', '0.0'))
 TEST_CORRUPT_RATE = float(os.getenv('TEST_CORRUPT_RATE', '0.0'))
 
+# Per-stage timings, only recorded with --profile
+profiler = profiling.Profiler()
+
 # Statistics for test mode
 test_stats = {
     'packets_received': 0,
@@ -69,12 +85,85 @@ def send_dns_query(query_string: str, server_ip: str, timeout: float = 5.0) -> b
         TXT record response string
     """
     print(f'SENDING {query_string} to server {server_ip}')
+    if USE_SCAPY:
+        result = send_dns_query_scapy(query_string, server_ip, timeout)
+    else:
+        result = send_dns_query_udp(query_string, server_ip, timeout)
+
+    # before returning what the client receives, we need to simulate 
+    # either corrupting part of the result OR dropping it entirely. INsert our 
+    # in the middle helper function here
+    return modify_packet(result)
+
+
+def send_dns_query_udp(query_string: str, server_ip: str, timeout: float) -> bytes:
+    """
+    Sends the DNS TXT query over a plain UDP socket (standard library only, no root needed).
+
+    Returns:
+        TXT record response bytes
+    """
     # Build DNS query packet
-    dns_query = DNSQR(qname=query_string, qtype='TXT')
-    packet = IP(dst = server_ip) / UDP(sport=random.randint(49152, 65535), dport=53) / DNS(rd=1,qd=dns_query)
+    with profiler.stage("build"):
+        query_id = random.randint(0, 0xFFFF)
+        packet = dns_wire.build_query(query_string, query_id)
+
+    # listen for response from SERVER
+    with profiler.stage("sr1"):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # connect() makes the kernel drop datagrams that aren't from the server
+            sock.connect((server_ip, 53))
+            sock.sendall(packet)
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"DNS query timed out after {timeout} seconds")
+                sock.settimeout(remaining)
+                try:
+                    response = sock.recv(4096)
+                except socket.timeout:
+                    raise TimeoutError(f"DNS query timed out after {timeout} seconds")
+                except ConnectionRefusedError:
+                    raise TimeoutError(f"DNS query refused by {server_ip}")
+                try:
+                    response_id, rcode, txt_records = dns_wire.parse_txt_response(response)
+                except ValueError as e:
+                    # Truncated or garbage datagram: treat it like a drop and keep waiting
+                    print(f"Ignoring malformed DNS reply: {e}")
+                    continue
+                # Ignore late replies to an earlier query we already gave up on
+                if response_id == query_id:
+                    break
+
+    # Check for DNS errors
+    if rcode != 0:
+        raise ValueError(f"DNS error: rcode={rcode}")
+
+    if not txt_records:
+        raise ValueError("No TXT record found in DNS response")
+
+    return txt_records[0]
+
+
+def send_dns_query_scapy(query_string: str, server_ip: str, timeout: float) -> bytes:
+    """
+    Sends the DNS TXT query with scapy's sr1. Only used with --scapy: it needs root and
+    importing scapy takes 1-2 seconds, but it's handy for debugging the raw packets.
+
+    Returns:
+        TXT record response bytes
+    """
+    from scapy.all import IP, DNSQR, UDP, DNS, sr1
+
+    # Build DNS query packet
+    with profiler.stage("build"):
+        dns_query = DNSQR(qname=query_string, qtype='TXT')
+        packet = IP(dst = server_ip) / UDP(sport=random.randint(49152, 65535), dport=53) / DNS(rd=1,qd=dns_query)
    
     # listen for response from SERVER
-    response = sr1(packet, timeout=timeout, verbose=False)
+    with profiler.stage("sr1"):
+        response = sr1(packet, timeout=timeout, verbose=False)
 
     if response is None:
         raise TimeoutError(f"DNS query timed out after {timeout} seconds")
@@ -100,40 +189,59 @@ def send_dns_query(query_string: str, server_ip: str, timeout: float = 5.0) -> b
             # Index into rdata field - return as bytes
             if isinstance(answer.rdata, bytes):
                 # we store this in a result variable
-                result = answer.rdata
+                return answer.rdata
             else:
                 # rdata is a list, get first element and encode to bytes
-                # store in result variable
-                result = answer.rdata[0].encode('utf-8') if isinstance(answer.rdata[0], str) else answer.rdata[0]
-
-            # before returning what the client receives, we need to simulate 
-            # either corrupting part of the result OR dropping it entirely. INsert our 
-            # in the middle helper function here
-            return modify_packet(result)
+                return answer.rdata[0].encode('utf-8') if isinstance(answer.rdata[0], str) else answer.rdata[0]
 
     raise ValueError("No TXT record found in DNS response")
 
 
-def send_initial_request(filename: str, session_id: str, server_ip: str) -> bytes:
+def send_initial_request(filename: str, session_id: str, server_ip: str, cached_entry: dict | None = None,
+                         bundle_mode: bool = False) -> bytes:
     """
     Sends GET request and waits for first chunk to be sent back.
+    If we have a cached copy we send a COND request instead, which the server
+    answers with a single NOTMOD packet when our copy is still current.
+    In bundle mode we send a BUNDLE request and the chunks make up a zip archive
+    of the page and its subresources.
 
     Args:
         filename: Name of file to request (e.g., "index.html")
         session_id: 6-character session ID
         server_ip: IP address of DNS server
+        cached_entry: ClientCache entry of our cached copy (sha256, etag, last_modified), or None
+        bundle_mode: request the page plus its CSS/JS/images as one archive
 
     Returns:
         First TXT record response
     """
     # Use protocol function to create GETquery with filename and session id
-    GET_query = protocol.encode_get(filename, session_id)
+    if bundle_mode:
+        GET_query = protocol.encode_bundle(filename, session_id)
+    elif cached_entry is None:
+        GET_query = protocol.encode_get(filename, session_id)
+    else:
+        GET_query = protocol.encode_cond_get(filename, cached_entry['sha256'][:protocol.DIGEST_LEN], session_id,
+                                             cached_entry['etag'], cached_entry['last_modified'])
+
+    # The server only answers a BUNDLE once it has fetched every asset, so give it longer
+    timeout = BUNDLE_TIMEOUT if bundle_mode else 5.0
+    # A COND or BUNDLE reply may be a one-packet NOTMOD/ERROR instead of chunk 0, so it must be checked here:
+    # receive_file's retransmit ACKs only make sense once we know the server started a session
+    check_reply = cached_entry is not None or bundle_mode
 
     # Loop for sending th einitial request (in case first packet is dropped/corrupted)
     max_retries = 10 
     for attempt in range(max_retries):
         try:
-            response = send_dns_query(GET_query, server_ip)
+            response = send_dns_query(GET_query, server_ip, timeout)
+            if check_reply and not is_valid_first_reply(response):
+                # Corrupted: resending the query is safe, the server just starts over
+                print("Corrupted reply to initial request, resending")
+                if attempt < max_retries - 1:
+                    continue
+                raise ValueError("Reply to initial request corrupted on every attempt")
             return response
         except TimeoutError as e:
             if "TEST MODE" in str(e):
@@ -150,7 +258,87 @@ def send_initial_request(filename: str, session_id: str, server_ip: str) -> byte
     raise TimeoutError("Failed to get initial response after retrying to send dns query")
 
 
-def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str) -> bytes:
+def is_valid_first_reply(reply: bytes) -> bool:
+    """
+    Checks a reply to a COND or BUNDLE request before we act on it.
+
+    Returns:
+        True for an intact NOTMOD/ERROR packet, or anything that decodes as chunk 0 (receive_file
+        checks that chunk's checksum itself). False if it doesn't decode, has another seq, or is a
+        NOTMOD/ERROR with a bad checksum
+    """
+    try:
+        seq_type, data_bytes, packet_checksum = protocol.decode_chunk(reply.decode())
+    except (UnicodeDecodeError, ValueError):
+        return False
+    if seq_type in ("NOTMOD", "ERROR"):
+        return protocol.calculate_checksum(data_bytes) == packet_checksum
+    return seq_type == 0
+
+
+def check_not_modified(first_chunk_txt: bytes) -> dict | None:
+    """
+    Checks whether the server answered our COND request with NOTMOD.
+
+    Args:
+        first_chunk_txt: First TXT record response from send_initial_request(), already
+                         checked with is_valid_first_reply()
+
+    Returns:
+        {"etag", "last_modified"} reported by the server if our cached copy is current, otherwise None
+
+    Raises:
+        ValueError if the server answered with ERROR (ex. the page is gone upstream)
+    """
+    seq_type, data_bytes, packet_checksum = protocol.decode_chunk(first_chunk_txt.decode())
+    if seq_type not in ("NOTMOD", "ERROR"):
+        return None
+    if seq_type == "ERROR":
+        raise ValueError(f"Server error: {data_bytes.decode(errors='replace')}")
+    return json.loads(data_bytes)
+
+
+def parse_meta(reply: bytes) -> dict | None:
+    """
+    Parses the server's reply to our META query.
+
+    Returns:
+        {"etag", "last_modified"} of the file we just received, or None if the reply isn't a valid META
+    """
+    try:
+        seq_type, data_bytes, packet_checksum = protocol.decode_chunk(reply.decode())
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if seq_type != "META" or protocol.calculate_checksum(data_bytes) != packet_checksum:
+        return None
+    try:
+        return json.loads(data_bytes)
+    except ValueError:
+        return None
+
+
+def request_validators(session_id: str, server_ip: str) -> dict | None:
+    """
+    Asks the server for the ETag / Last-Modified of the file this session just transferred.
+    We already have the whole file, so a lost or broken reply just means no validators.
+
+    Returns:
+        {"etag", "last_modified"} or None
+    """
+    META_query = protocol.encode_meta(session_id)
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            validators = parse_meta(send_dns_query(META_query, server_ip))
+        except (TimeoutError, ValueError):
+            continue
+        if validators is not None:
+            return validators
+    return None
+
+
+def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str,
+                 fetch_validators: bool = False) -> tuple[bytes, dict | None]:
     """
     Receives file chunks using Stop-and-Wait protocol.
 
@@ -158,9 +346,10 @@ def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str) -> byt
         first_chunk_txt: First TXT record response from send_initial_request()
         session_id: session id of files we're transmitting
         server_ip: of the server we are looking for
+        fetch_validators: after DONE, also ask the server for the file's ETag / Last-Modified
 
     Returns:
-        Complete file as bytes
+        (Complete file as bytes, {"etag", "last_modified"} from the server or None)
     """
     chunks = []
 
@@ -168,6 +357,7 @@ def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str) -> byt
     # NOTE: ChatGPT suggested I add these statistics and track them as such
     total_bytes = 0
     duplicate_count = 0
+    validators = None
 
     # first chunk we call the function ith
     expected_seq_type = 0
@@ -187,9 +377,11 @@ def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str) -> byt
     while True:
         # decode current chunk with protocol
         
-        seq_type, data_bytes, packet_checksum = protocol.decode_chunk(current_txt)
+        with profiler.stage("decode"):
+            seq_type, data_bytes, packet_checksum = protocol.decode_chunk(current_txt)
         # calculate checksum
-        checksum = protocol.calculate_checksum(data_bytes)
+        with profiler.stage("verify"):
+            checksum = protocol.calculate_checksum(data_bytes)
         # verify checksum
         if checksum == packet_checksum:
             # if checksum is valid and seq type is DONE
@@ -200,6 +392,9 @@ def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str) -> byt
                 # create ACK message and send back to server that we received it
                 ACK_message = protocol.encode_ack(expected_seq_type, session_id)
                 send_dns_query(ACK_message, server_ip)
+                # Only now that DONE is verified, ask for the validators for our cache
+                if fetch_validators:
+                    validators = request_validators(session_id, server_ip)
                 break
             # At this point seq_type must be int (0 or 1), not "DONE"
             assert isinstance(seq_type, int), "seq_type must be int here"
@@ -273,7 +468,7 @@ def receive_file(first_chunk_txt: bytes, session_id: str, server_ip: str) -> byt
     # Reassemble all chunks into complete file
     complete_file = b''.join(chunks)
 
-    return complete_file
+    return complete_file, validators
 
 
 def main():
@@ -291,8 +486,26 @@ def main():
     parser = argparse.ArgumentParser(description='DNS Tunnel Client')
     parser.add_argument('filename', help='File to request (e.g., index.html)')
     parser.add_argument('--server', required=True, help='DNS server IP address')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the local cache')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory of the local cache')
+    parser.add_argument('--cache-max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='Evict least recently used files once the cache grows past this')
+    parser.add_argument('--scapy', action='store_true',
+                        help='Send queries with scapy instead of a UDP socket (needs root, slow to start, for debugging)')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Fetch the page plus its same-origin CSS/JS/images as one archive and unpack it')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record per-stage timings and print a histogram at the end')
+    parser.add_argument('--profile-out',
+                        help='With --profile, also write a cProfile file (.pstats/.prof) or a Chrome trace JSON (anything else)')
     args = parser.parse_args()
 
+    if args.profile:
+        profiler.enable(args.profile_out)
+
+    global USE_SCAPY
+    USE_SCAPY = args.scapy
+
     filename = args.filename
     server_ip = args.server # 172.25.162.183
 
@@ -316,19 +529,52 @@ def main():
 
     # Wrap in try except for saftey
     try:
+        # If we fetched this file before, ask the server to only send it if it changed
+        cache = None
+        cached_entry = None
+        # Bundles are unpacked into a directory rather than cached as one file
+        if not args.no_cache and not args.bundle:
+            cache = ClientCache(args.cache_dir, args.cache_max_bytes)
+            cached_entry = cache.lookup(filename)
+            if cached_entry is not None:
+                print(f"cached copy found ({cached_entry['size']} bytes), revalidating with server")
+
         # FLOW #3. Send GET initiator
         print(f"sending GET request for file: {filename}...")
-        initial_chunk_txt = send_initial_request(filename, session_id, server_ip)
-        print(f"Received initial chunk from server => we start file transfer now")
-        print()
+        initial_chunk_txt = send_initial_request(filename, session_id, server_ip, cached_entry, args.bundle)
+
+        not_modified = None
+        if cached_entry is not None or args.bundle:
+            # Raises if the server answered ERROR (ex. the page is gone upstream)
+            not_modified = check_not_modified(initial_chunk_txt)
+
+        if not_modified is not None:
+            # One round trip: server confirmed our cached copy is current
+            print(f"Server says cached copy is current => skipping transfer")
+            cache.update_validators(filename, not_modified.get('etag'), not_modified.get('last_modified'))
+            file_data = cache.read(filename)
+        else:
+            print(f"Received initial chunk from server => we start file transfer now")
+            print()
 
-        # FLOW #4. Receive the file
-        file_data = receive_file(initial_chunk_txt, session_id, server_ip)
+            # FLOW #4. Receive the file
+            file_data, validators = receive_file(initial_chunk_txt, session_id, server_ip, cache is not None)
+            if cache is not None:
+                if validators is None:
+                    validators = {}
+                cache.put(filename, file_data, validators.get('etag'), validators.get('last_modified'))
 
         # FLOW #5. Write the received to directory
-        output_filename = f"received_{filename}.html"
-        with open(output_filename, 'wb') as f:
-            f.write(file_data)
+        with profiler.stage("write"):
+            if args.bundle:
+                # Unpack the archive and point the page's links at the local copies
+                import bundle
+                output_dir = f"received_{filename.replace('/', '_')}_bundle"
+                output_filename = bundle.unpack_bundle(file_data, output_dir)
+            else:
+                output_filename = f"received_{filename}.html"
+                with open(output_filename, 'wb') as f:
+                    f.write(file_data)
 
         # FLOW #6. Print stats
         # NOTE: ChatGPT suggested I add trackers for these statistics and print them as such
@@ -363,6 +609,11 @@ def main():
         import traceback
         traceback.print_exc()
 
+    # Failed and timed out transfers are when the stage breakdown matters most, so always report
+    finally:
+        profiler.report()
+        profiler.dump()
+
 
 if __name__ == "__main__":
     main()